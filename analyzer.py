@@ -1,132 +1,254 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from llama_cpp import Llama
 from embeddings import EmbeddingsManager
 import os
+import re
+import json
+import heapq
+import hashlib
+import sqlite3
+import threading
+
+# Only the beginning of a note is ever embedded or shown to the LLM
+NOTE_HEAD_CHARS = 1500  # read from disk; used for the key concepts and as the similarity query
+CONNECTION_HEAD_CHARS = 800  # used in the connection prompt
+
+# Prompt templates
+KEY_CONCEPTS_PROMPT = """Analyze this note and extract the key practical concepts, tools, methods, or strategies mentioned:
+
+Content:
+{content}...
+
+List the key concepts, one per line, focusing on practical and actionable items."""
+
+CONNECTION_PROMPT = """Analyze the relationship between these two notes, focusing on practical knowledge and applications.
+
+Note 1 Key Concepts:
+{key_concepts}
+
+Note 1:
+{source}...
+
+Note 2:
+{target}...
+
+Provide a detailed analysis in the following format:
+
+1. Relationship: [Explain how these notes are connected conceptually]
+2. Shared Concepts: [List the specific concepts, tools, or methods that appear in both notes]
+3. Practical Applications: [Describe how the knowledge from both notes could be combined or applied practically]"""
+
+# Sections of a connection analysis; any of them may be missing (the model can skip a header,
+# and 2. and 3. are lost if generation stopped early)
+_SECTION_RE = re.compile(
+    r'(?:1\.\s*Relationship:\s*(?P<rel>.*?)\s*)?'
+    r'(?:2\.\s*Shared Concepts:\s*(?P<sc>.*?)\s*)?'
+    r'(?:3\.\s*Practical Applications:\s*(?P<pa>.*?))?\s*$',
+    re.DOTALL,
+)
+
+# Bump when generation settings change, so cached answers from older settings are ignored
+CACHE_VERSION = 1
+
+class _ResponseCache:
+    """Persistent cache of LLM results, stored as JSON in a SQLite table."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Return the cached value for key, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value) -> None:
+        """Store a JSON-serializable value under key."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)",
+                (key, json.dumps(value))
+            )
+            self._conn.commit()
+
+# Loaded models, shared by every NoteAnalyzer in the process.
+# Each model is paired with a lock: a llama.cpp context can only decode one prompt at a time.
+_LLM_CACHE: Dict[Tuple, Tuple[Llama, threading.Lock]] = {}
+_LLM_CACHE_LOCK = threading.Lock()
+
+def _get_llm(model_path: str, n_ctx: int, n_threads: int, n_gpu_layers: int = 0) -> Tuple[Llama, threading.Lock]:
+    """Return the Llama instance for these settings and its lock, loading it on first use."""
+    key = (model_path, n_ctx, n_threads, n_gpu_layers)
+    with _LLM_CACHE_LOCK:
+        entry = _LLM_CACHE.get(key)
+        if entry is None:
+            llm = Llama(
+                model_path=model_path,
+                n_ctx=n_ctx,  # Context window
+                n_batch=n_ctx,  # Prefill whole prompts in a single batch
+                n_threads=n_threads,
+                n_threads_batch=n_threads,
+                n_gpu_layers=n_gpu_layers,  # Layers offloaded to Metal/CUDA (0 = CPU only)
+                use_mmap=True,
+                use_mlock=False,
+            )
+            entry = (llm, threading.Lock())
+            _LLM_CACHE[key] = entry
+        return entry
 
 class NoteAnalyzer:
     def __init__(self, embeddings_manager: EmbeddingsManager):
         """Initialize the note analyzer."""
         self.embeddings_manager = embeddings_manager
-        # Initialize Llama model
-        model_path = os.getenv("LLAMA_MODEL_PATH", "models/llama-2-7b-chat.gguf")
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=2048,  # Context window
-            n_threads=os.cpu_count(),  # Use all CPU cores
+        # Similar notes below this score are not worth an LLM call. Cosine similarity ranges
+        # from -1 to 1, so the default of -1 keeps every note
+        self.min_similarity = float(os.getenv("MIN_CONNECTION_SIMILARITY", "-1"))
+        # At most this many notes are analyzed per call
+        self.max_connections = int(os.getenv("MAX_CONNECTIONS", "10"))
+        # Reuse the process-wide Llama model (loaded on first use)
+        model_path = os.getenv("LLAMA_MODEL_PATH", "models/llama-2-7b-chat.Q4_K_M.gguf")
+        n_gpu_layers = int(os.getenv("LLAMA_N_GPU_LAYERS", "0"))
+        # More than 16 threads stops helping token generation
+        self.llm, self._llm_lock = _get_llm(
+            model_path,
+            n_ctx=2048,
+            n_threads=min(os.cpu_count() or 1, 16),
+            n_gpu_layers=n_gpu_layers,
         )
+        self.model_path = model_path
+        # LLM answers survive restarts, so unchanged notes are not analyzed twice
+        self.cache = _ResponseCache(os.getenv("ANALYZER_CACHE_PATH", "./cache/analyzer.sqlite3"))
 
     def analyze_connections(self, new_note_path: str) -> List[Dict]:
         """Analyze connections between a new note and existing notes."""
-        # Read the new note's content
+        # Read the beginning of the new note's content
         with open(new_note_path, 'r', encoding='utf-8') as f:
-            new_note_content = f.read()
+            note_head = f.read(NOTE_HEAD_CHARS)
+        connection_head = note_head[:CONNECTION_HEAD_CHARS]
 
         # Extract key concepts from the new note
-        key_concepts = self._extract_key_concepts(new_note_content)
+        key_concepts = self._extract_key_concepts(note_head)
         
-        # Find similar documents based on the entire content
-        similar_docs = self.embeddings_manager.find_similar_documents(new_note_content, n_results=10)
+        # Find similar documents based on the head of the note
+        similar_docs = self.embeddings_manager.find_similar_documents(note_head, n_results=10)
         
-        # Analyze connections using Llama
-        connections = []
+        # Keep only the closest chunk of each file, so every note is analyzed once
+        best_by_file: Dict[str, Dict] = {}
         for doc in similar_docs:
-            if doc["metadata"]["file_path"] != new_note_path:  # Avoid self-references
-                connection = self._analyze_connection(new_note_content, doc["document"], key_concepts)
-                if connection:
-                    connections.append({
-                        "file_path": doc["metadata"]["file_path"],
-                        "relationship": connection["relationship"],
-                        "practical_applications": connection["practical_applications"],
-                        "key_concepts": connection["shared_concepts"],
-                        "similarity_score": 1 - doc["distance"]
-                    })
+            file_path = doc["metadata"]["file_path"]
+            if file_path == new_note_path:  # Avoid self-references
+                continue
+            if file_path not in best_by_file or doc["distance"] < best_by_file[file_path]["distance"]:
+                best_by_file[file_path] = doc
+
+        # Analyze connections using Llama, only for the closest notes that are similar enough
+        candidates = heapq.nsmallest(
+            self.max_connections,
+            (doc for doc in best_by_file.values() if 1 - doc["distance"] >= self.min_similarity),
+            key=lambda doc: doc["distance"],
+        )
+        prompts = [self._build_connection_prompt(connection_head, doc["document"], key_concepts)
+                   for doc in candidates]
+        analyses = self._analyze_connections_batch(prompts)
+
+        connections = []
+        for doc, connection in zip(candidates, analyses):
+            if connection:
+                connections.append({
+                    "file_path": doc["metadata"]["file_path"],
+                    "relationship": connection["relationship"],
+                    "practical_applications": connection["practical_applications"],
+                    "key_concepts": connection["shared_concepts"],
+                    "similarity_score": 1 - doc["distance"]
+                })
 
         return connections
 
     def _extract_key_concepts(self, content: str) -> List[str]:
         """Extract key concepts from the content using Llama."""
-        prompt = f"""Analyze this note and extract the key practical concepts, tools, methods, or strategies mentioned:
-
-Content:
-{content[:1500]}...
+        prompt = KEY_CONCEPTS_PROMPT.format(content=content[:NOTE_HEAD_CHARS])
+        cache_key = self._cache_key(prompt)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-List the key concepts, one per line, focusing on practical and actionable items."""
-
-        response = self.llm(
-            prompt,
-            max_tokens=200,
-            temperature=0.3,
-            stop=["Content:", "\n\n"]
-        )
+        with self._llm_lock:
+            response = self.llm(
+                prompt,
+                max_tokens=96,
+                temperature=0.3,
+                stop=["Content:", "\n\n", "Example:"]
+            )
         
         concepts = [concept.strip() for concept in response['choices'][0]['text'].split('\n') if concept.strip()]
+        self.cache.set(cache_key, concepts)
         return concepts
 
-    def _analyze_connection(self, source_content: str, target_content: str, key_concepts: List[str]) -> Dict:
-        """Use Llama to analyze the connection between two notes with focus on practical applications."""
-        prompt = f"""Analyze the relationship between these two notes, focusing on practical knowledge and applications.
+    def _cache_key(self, prompt: str) -> str:
+        """Cache key for a prompt: the prompt already contains the (truncated) note content."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{CACHE_VERSION}\0{self.model_path}\0".encode('utf-8'))
+        digest.update(prompt.encode('utf-8'))
+        return digest.hexdigest()
 
-Note 1 Key Concepts:
-{chr(10).join(key_concepts)}
+    def _build_connection_prompt(self, source_content: str, target_content: str, key_concepts: List[str]) -> str:
+        """Build the prompt comparing two notes; everything up to "Note 2:" depends only on the source note."""
+        return CONNECTION_PROMPT.format(
+            key_concepts="\n".join(key_concepts),
+            source=source_content[:CONNECTION_HEAD_CHARS],
+            target=target_content[:CONNECTION_HEAD_CHARS],
+        )
 
-Note 1:
-{source_content[:800]}...
+    def _analyze_connections_batch(self, prompts: List[str]) -> List[Dict]:
+        """Run connection prompts back-to-back and return the parsed analyses, in order."""
+        keys = [self._cache_key(prompt) for prompt in prompts]
+        analyses = [self.cache.get(key) for key in keys]
+        pending = [i for i, analysis in enumerate(analyses) if analysis is None]
 
-Note 2:
-{target_content[:800]}...
+        texts = []
+        # Hold the lock for the whole batch so no other prompt evicts the shared prefix
+        with self._llm_lock:
+            for i in pending:
+                response = self.llm(
+                    prompts[i],
+                    max_tokens=256,
+                    # Low temperature: cached answers should be the model's most likely reading,
+                    # not whichever random sample happened to be drawn first
+                    temperature=0.1,
+                    # Stop as soon as the model moves past the three requested sections
+                    stop=["Note 1:", "Note 2:", "\n4.", "\n\n\n"]
+                )
+                texts.append(response['choices'][0]['text'])
 
-Provide a detailed analysis in the following format:
+        for i, text in zip(pending, texts):
+            analyses[i] = self._parse_connection(text)
+            self.cache.set(keys[i], analyses[i])
+        return analyses
 
-1. Relationship: [Explain how these notes are connected conceptually]
-2. Shared Concepts: [List the specific concepts, tools, or methods that appear in both notes]
-3. Practical Applications: [Describe how the knowledge from both notes could be combined or applied practically]"""
-
-        response = self.llm(
-            prompt,
-            max_tokens=500,
-            temperature=0.7,
-            stop=["Note 1:", "Note 2:"]
-        )
-
-        text = response['choices'][0]['text']
-        
-        # Parse the response into sections
-        sections = text.split('\n')
-        relationship = ""
-        shared_concepts = []
-        practical_applications = ""
-        
-        current_section = ""
-        for line in sections:
-            if line.startswith("1. Relationship:"):
-                current_section = "relationship"
-                relationship = line.replace("1. Relationship:", "").strip()
-            elif line.startswith("2. Shared Concepts:"):
-                current_section = "concepts"
-                shared_concepts = []
-            elif line.startswith("3. Practical Applications:"):
-                current_section = "applications"
-                practical_applications = line.replace("3. Practical Applications:", "").strip()
-            elif line.strip():
-                if current_section == "relationship":
-                    relationship += " " + line.strip()
-                elif current_section == "concepts":
-                    shared_concepts.append(line.strip())
-                elif current_section == "applications":
-                    practical_applications += " " + line.strip()
+    def _parse_connection(self, text: str) -> Dict:
+        """Parse the model's answer into relationship, shared concepts and applications."""
+        match = _SECTION_RE.search(text)
+        if not match:
+            return {"relationship": "", "shared_concepts": [], "practical_applications": ""}
 
         return {
-            "relationship": relationship,
-            "shared_concepts": shared_concepts,
-            "practical_applications": practical_applications
+            "relationship": " ".join((match["rel"] or "").split()),
+            "shared_concepts": [line.strip() for line in (match["sc"] or "").splitlines() if line.strip()],
+            "practical_applications": " ".join((match["pa"] or "").split())
         }
 
     def suggest_backlinks(self, note_path: str) -> List[Dict]:
         """Suggest backlinks for a note based on content analysis."""
         with open(note_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+            note_head = f.read(NOTE_HEAD_CHARS)
 
-        similar_docs = self.embeddings_manager.find_similar_documents(content)
+        similar_docs = self.embeddings_manager.find_similar_documents(note_head)
         
         backlinks = []
         for doc in similar_docs:
@@ -1,22 +1,29 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 from embeddings import EmbeddingsManager
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from pydantic import BaseModel
 import numpy as np
-from sklearn.manifold import TSNE
+from openTSNE import TSNE
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
+import gzip
+import pickle
+import hashlib
+import threading
+import orjson
 import logging
 
 # Configurazione logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Second Brain Vector DB Viewer")
+# orjson per tutte le risposte JSON: serializzazione in C, anche degli array numpy
+app = FastAPI(title="Second Brain Vector DB Viewer", default_response_class=ORJSONResponse)
 
 # Configurazione CORS
 app.add_middleware(
@@ -31,14 +38,41 @@ app.add_middleware(
 data_dir = os.path.join(os.path.dirname(__file__), "data")
 embeddings_manager = EmbeddingsManager(data_dir)
 
+# Cache del plot 3D (proiezione t-SNE, indice dei file, testi di hover, figura base):
+# viene ricalcolata solo quando cambiano gli id o gli embedding della collezione
+_PLOT_CACHE = {"sig": None, "reduced": None, "path_index": None, "hover_data": None, "base_figure": None}
+_PLOT_CACHE_LOCK = threading.Lock()
+_NO_POINTS = np.empty(0, dtype=np.int64)
+
+# Proiezione t-SNE salvata su disco: sopravvive ai riavvii e permette aggiornamenti incrementali
+TSNE_CACHE_FILE = os.path.join(data_dir, "tsne_cache.pkl")
+# Se i chunk nuovi o modificati superano questa frazione, la proiezione viene ricalcolata da zero
+TSNE_MAX_INCREMENTAL_FRACTION = 0.2
+# {"embedding": TSNEEmbedding, "positions": {chiave chunk: coordinate 3D}, "fitted": chiavi dell'ultimo fit}
+_TSNE_STATE = None
+
 class SearchRequest(BaseModel):
     query: str
     n_results: int = 5
 
-@app.get("/visualizer", response_class=HTMLResponse)
-async def get_visualizer():
-    """Pagina di visualizzazione 3D degli embedding."""
-    return """
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    n_results: int = 5
+
+def _precompress(html: str) -> Tuple[bytes, bytes]:
+    """Codifica una pagina statica una volta sola: (UTF-8, UTF-8 compresso con gzip)."""
+    raw = html.encode("utf-8")
+    return raw, gzip.compress(raw, compresslevel=6)
+
+def _page_response(request: Request, page: Tuple[bytes, bytes]) -> HTMLResponse:
+    """Restituisce una pagina precompressa, in gzip se il client lo accetta."""
+    raw, compressed = page
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return HTMLResponse(compressed, headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return HTMLResponse(raw, headers={"Vary": "Accept-Encoding"})
+
+# Pagina di visualizzazione 3D degli embedding
+VISUALIZER_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -77,7 +111,7 @@ async def get_visualizer():
                     document.getElementById('loading').style.display = 'block';
                     document.getElementById('error').textContent = '';
                     
-                    const response = await fetch('/plot3d');
+                    const response = await fetch('/plot3d/base');
                     if (!response.ok) {
                         throw new Error('Errore nel caricamento del plot');
                     }
@@ -105,21 +139,30 @@ async def get_visualizer():
                         return;
                     }
 
+                    if (!currentPlot) {
+                        await loadPlot();
+                        if (!currentPlot) {
+                            return;
+                        }
+                    }
+
                     document.getElementById('loading').style.display = 'block';
                     document.getElementById('error').textContent = '';
                     
-                    const response = await fetch('/plot3d?query=' + encodeURIComponent(query));
+                    // Il plot base resta quello già caricato: il server restituisce solo i punti da evidenziare
+                    const response = await fetch('/plot3d/highlight?query=' + encodeURIComponent(query));
                     if (!response.ok) {
                         throw new Error('Errore nella ricerca');
                     }
                     
-                    const plotData = await response.json();
-                    if (!plotData.data || plotData.data.length === 0) {
+                    const highlight = await response.json();
+                    if (highlight.indices.length === 0) {
                         throw new Error('Nessun risultato trovato');
                     }
                     
-                    Plotly.newPlot('plot', plotData.data, plotData.layout);
-                    currentPlot = plotData;
+                    const colors = new Array(currentPlot.stats.total_points).fill('blue');
+                    highlight.indices.forEach(i => { colors[i] = 'red'; });
+                    Plotly.restyle('plot', { 'marker.color': [colors] });
                 } catch (error) {
                     document.getElementById('error').textContent = error.message;
                     console.error('Errore:', error);
@@ -141,91 +184,258 @@ async def get_visualizer():
     </body>
     </html>
     """
+_VISUALIZER_PAGE = _precompress(VISUALIZER_HTML)
+
+@app.get("/visualizer", response_class=HTMLResponse)
+async def get_visualizer(request: Request):
+    """Pagina di visualizzazione 3D degli embedding."""
+    return _page_response(request, _VISUALIZER_PAGE)
 
 @app.get("/plot3d")
 async def get_plot3d(query: str = None):
     """Genera il plot 3D degli embedding."""
+    # t-SNE e ChromaDB sono bloccanti: eseguili fuori dall'event loop
+    plot = await run_in_threadpool(_build_plot3d, query)
+    return ORJSONResponse(plot)
+
+@app.get("/plot3d/base")
+async def get_plot3d_base():
+    """Plot 3D di tutti gli embedding, senza evidenziazioni."""
     try:
-        # Ottieni tutti gli embedding dal database
-        results = embeddings_manager.collection.get(
-            include=["embeddings", "metadatas", "documents"]
-        )
-        
-        if not results["embeddings"]:
+        plot_cache = await run_in_threadpool(_load_plot_cache)
+    except Exception as e:
+        logger.error(f"Errore nella generazione del plot 3D: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if plot_cache is None:
+        raise HTTPException(status_code=404, detail="Nessun embedding trovato nel database")
+    return ORJSONResponse(plot_cache["base_figure"])
+
+@app.get("/plot3d/highlight")
+async def get_plot3d_highlight(query: str):
+    """Posizioni, nel plot base, dei chunk dei documenti più simili alla query."""
+    try:
+        plot_cache = await run_in_threadpool(_get_cached_plot)
+        if plot_cache is None:
+            raise HTTPException(status_code=404, detail="Nessun embedding trovato nel database")
+
+        similar_docs = await run_in_threadpool(embeddings_manager.find_similar_documents, query, 5)
+        indices = _highlight_indices(plot_cache["path_index"], similar_docs)
+        return {"indices": indices.tolist(), "query": query}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Errore nella ricerca di documenti simili: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _build_plot3d(query: Optional[str]) -> Dict:
+    """Calcola la proiezione 3D degli embedding e costruisce il plot."""
+    try:
+        plot_cache = _load_plot_cache()
+        if plot_cache is None:
             return {"error": "Nessun embedding trovato nel database"}
-            
-        # Converti gli embedding in numpy array
-        embeddings = np.array(results["embeddings"])
+        n_points = plot_cache["reduced"].shape[1]
         
-        # Riduci la dimensionalità a 3D usando t-SNE
-        tsne = TSNE(n_components=3, random_state=42)
-        embeddings_3d = tsne.fit_transform(embeddings)
-        
-        # Prepara i dati per il plot
-        plot_data = []
-        
-        # Colori per i punti
-        colors = ['blue'] * len(embeddings_3d)
+        # Punti da evidenziare: 1 = documento simile (rosso), 0 = altro (blu)
+        highlight = np.zeros(n_points, dtype=np.uint8)
         
         # Se c'è una query, cerca i documenti simili
         if query:
             try:
                 similar_docs = embeddings_manager.find_similar_documents(query, n_results=5)
-                similar_paths = [doc["metadata"]["file_path"] for doc in similar_docs]
                 
-                # Evidenzia i documenti simili in rosso
-                for i, metadata in enumerate(results["metadatas"]):
-                    if metadata["file_path"] in similar_paths:
-                        colors[i] = 'red'
+                # Evidenzia i documenti simili in rosso, con un'unica assegnazione vettoriale
+                highlight[_highlight_indices(plot_cache["path_index"], similar_docs)] = 1
             except Exception as e:
                 logger.error(f"Errore nella ricerca di documenti simili: {str(e)}")
         
-        # Crea il plot
-        fig = go.Figure(data=[go.Scatter3d(
-            x=embeddings_3d[:, 0],
-            y=embeddings_3d[:, 1],
-            z=embeddings_3d[:, 2],
-            mode='markers',
-            marker=dict(
-                size=8,
-                color=colors,
-                opacity=0.8
-            ),
-            text=[f"File: {metadata['file_path']}<br>Chunk: {metadata['chunk_index'] + 1}/{metadata['total_chunks']}" 
-                  for metadata in results["metadatas"]],
-            hoverinfo='text'
-        )])
-        
-        # Aggiorna il layout
-        fig.update_layout(
-            title='Visualizzazione 3D degli Embedding',
-            scene=dict(
-                xaxis_title='X',
-                yaxis_title='Y',
-                zaxis_title='Z'
-            ),
-            margin=dict(l=0, r=0, t=30, b=0)
-        )
-        
-        # Converti il plot in HTML
-        plot_html = fig.to_html(full_html=False)
+        fig = _make_figure(plot_cache["reduced"], plot_cache["hover_data"], highlight)
         
-        return {
-            "plot": plot_html,
-            "stats": {
-                "total_points": len(embeddings_3d),
-                "query": query if query else None
-            }
+        # Solo dati e layout della figura: il client la disegna con Plotly.react, senza HTML generato qui
+        plot = fig.to_plotly_json()
+        plot["stats"] = {
+            "total_points": n_points,
+            "query": query if query else None
         }
+        return plot
         
     except Exception as e:
         logger.error(f"Errore nella generazione del plot 3D: {str(e)}")
         return {"error": f"Errore nella generazione del plot: {str(e)}"}
 
-@app.get("/", response_class=HTMLResponse)
-async def get_index():
-    """Pagina principale con interfaccia utente."""
-    return """
+def _highlight_indices(path_index: Dict[str, np.ndarray], similar_docs: List[Dict]) -> np.ndarray:
+    """Posizioni ordinate dei chunk dei file trovati; ogni file è considerato una sola volta."""
+    # Più chunk dello stesso file possono comparire tra i risultati
+    similar_paths = dict.fromkeys(doc["metadata"]["file_path"] for doc in similar_docs)
+    return np.unique(np.concatenate(
+        [_NO_POINTS] + [path_index.get(path, _NO_POINTS) for path in similar_paths]
+    ))
+
+def _make_figure(reduced: np.ndarray, hover_data: List[List], highlight: Optional[np.ndarray] = None) -> go.Figure:
+    """Crea la figura Plotly a partire dalla proiezione 3D (3, N)."""
+    # Gli assi restano array numpy: le route restituiscono la figura con ORJSONResponse, che li
+    # serializza senza passare da liste Python (e senza jsonable_encoder, che non li accetta)
+    xs, ys, zs = reduced
+    marker = dict(size=8, color='blue', opacity=0.8)
+    if highlight is not None:
+        # Maschera numerica con colorscale: Plotly valida l'array in blocco, non N stringhe di colore
+        marker.update(color=highlight, colorscale=[[0, 'blue'], [1, 'red']], cmin=0, cmax=1)
+    fig = go.Figure(data=[go.Scatter3d(
+        x=xs,
+        y=ys,
+        z=zs,
+        mode='markers',
+        marker=marker,
+        # Il browser compone il testo di hover da hover_data ([file, chunk, totale] per punto)
+        customdata=hover_data,
+        hovertemplate='File: %{customdata[0]}<br>Chunk: %{customdata[1]}/%{customdata[2]}<extra></extra>'
+    )])
+    
+    # Aggiorna il layout
+    fig.update_layout(
+        title='Visualizzazione 3D degli Embedding',
+        scene=dict(
+            xaxis_title='X',
+            yaxis_title='Y',
+            zaxis_title='Z'
+        ),
+        margin=dict(l=0, r=0, t=30, b=0)
+    )
+    return fig
+
+def _load_plot_cache() -> Optional[Dict]:
+    """Legge la collezione e restituisce la cache del plot, scaricando gli embedding solo se è cambiata."""
+    # Id e metadati bastano a capire se la collezione è cambiata
+    results = embeddings_manager.collection.get(include=["metadatas"])
+    if not results["ids"]:
+        return None
+    
+    sig = _collection_signature(results["ids"], results["metadatas"])
+    with _PLOT_CACHE_LOCK:
+        if sig == _PLOT_CACHE["sig"]:
+            return dict(_PLOT_CACHE)
+    
+    # La collezione è cambiata: servono gli embedding (i testi dei chunk non sono usati dal plot)
+    results = embeddings_manager.collection.get(include=["embeddings", "metadatas"])
+    if not results["ids"]:
+        return None
+        
+    # Converti gli embedding in un array float32 contiguo (metà dei byte rispetto a float64)
+    embeddings = np.ascontiguousarray(np.asarray(results["embeddings"], dtype=np.float32))
+    return _get_plot_cache(results["ids"], embeddings, results["metadatas"])
+
+def _collection_signature(ids: List[str], metadatas: List[Dict]) -> str:
+    """Firma del contenuto della collezione: id dei chunk più hash del file da cui provengono."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk_id, metadata in zip(ids, metadatas):
+        digest.update(f"{chunk_id}\x00{metadata.get('file_hash')}\x00".encode("utf-8"))
+    return digest.hexdigest()
+
+def _get_cached_plot() -> Optional[Dict]:
+    """Restituisce la cache del plot così com'è, leggendo la collezione solo se è ancora vuota."""
+    with _PLOT_CACHE_LOCK:
+        if _PLOT_CACHE["sig"] is not None:
+            return dict(_PLOT_CACHE)
+    return _load_plot_cache()
+
+def _get_plot_cache(ids: List[str], embeddings: np.ndarray, metadatas: List[Dict]) -> Dict:
+    """Restituisce proiezione 3D (3, N), indice dei file e figura base, ricalcolandoli solo se i dati sono cambiati."""
+    sig = _collection_signature(ids, metadatas)
+    # Il lock evita che richieste concorrenti ricalcolino la stessa proiezione
+    with _PLOT_CACHE_LOCK:
+        if sig != _PLOT_CACHE["sig"]:
+            # Un asse per riga contigua: Plotly serializza ogni asse senza copie
+            reduced = np.ascontiguousarray(_project_3d(ids, embeddings).T)
+
+            # Indice file -> posizioni dei suoi chunk, per evidenziare i risultati in O(K)
+            positions = {}
+            for i, metadata in enumerate(metadatas):
+                positions.setdefault(metadata["file_path"], []).append(i)
+            path_index = {path: np.asarray(idx, dtype=np.int64) for path, idx in positions.items()}
+
+            hover_data = [[metadata["file_path"], metadata["chunk_index"] + 1, metadata["total_chunks"]]
+                          for metadata in metadatas]
+
+            # Figura senza evidenziazioni servita da /plot3d/base
+            base_figure = _make_figure(reduced, hover_data).to_plotly_json()
+            base_figure["stats"] = {"total_points": reduced.shape[1]}
+
+            _PLOT_CACHE.update(
+                sig=sig,
+                reduced=reduced,
+                path_index=path_index,
+                hover_data=hover_data,
+                base_figure=base_figure,
+            )
+        return dict(_PLOT_CACHE)
+
+def _project_3d(ids: List[str], embeddings: np.ndarray) -> np.ndarray:
+    """Proietta gli embedding in 3D (N, 3), riusando la proiezione salvata; va chiamata con _PLOT_CACHE_LOCK acquisito."""
+    global _TSNE_STATE
+    if _TSNE_STATE is None:
+        _TSNE_STATE = _load_tsne_state()
+
+    # Ogni chunk è identificato da id + hash del suo embedding
+    keys = [f"{chunk_id}:{hashlib.blake2b(row, digest_size=8).hexdigest()}"
+            for chunk_id, row in zip(ids, embeddings)]
+
+    if _TSNE_STATE:
+        positions = _TSNE_STATE["positions"]
+        missing = [i for i, key in enumerate(keys) if key not in positions]
+        # Conta anche i punti già collocati con transform(): la proiezione di riferimento
+        # invecchia con ogni modifica, non solo con quelle di questa chiamata
+        fitted = _TSNE_STATE.get("fitted", frozenset())
+        not_fitted = sum(1 for key in keys if key not in fitted)
+        if not_fitted <= TSNE_MAX_INCREMENTAL_FRACTION * len(keys):
+            # Solo i chunk nuovi vengono collocati con transform() sulla proiezione esistente
+            if missing:
+                new_points = np.asarray(_TSNE_STATE["embedding"].transform(embeddings[missing]))
+                positions.update(zip((keys[i] for i in missing), new_points))
+            # Mantieni solo i chunk ancora presenti nella collezione
+            _TSNE_STATE["positions"] = {key: positions[key] for key in keys}
+            if missing or len(positions) != len(keys):
+                _save_tsne_state(_TSNE_STATE)
+            return np.array([positions[key] for key in keys], dtype=np.float32)
+
+    # Nessuna proiezione salvata, o troppi chunk fuori dall'ultimo fit: ricalcola t-SNE su tutti i punti
+    # openTSNE: vicini approssimati e gradiente Barnes-Hut multi-thread
+    # (il metodo FFT supporta al massimo 2 dimensioni)
+    tsne = TSNE(
+        n_components=3,
+        negative_gradient_method="bh",
+        neighbors="approx",
+        n_jobs=-1,
+        random_state=42,
+    )
+    embedding = tsne.fit(embeddings)
+    _TSNE_STATE = {"embedding": embedding, "positions": dict(zip(keys, np.asarray(embedding))), "fitted": frozenset(keys)}
+    _save_tsne_state(_TSNE_STATE)
+    return np.asarray(embedding, dtype=np.float32)
+
+def _load_tsne_state() -> Optional[Dict]:
+    """Carica la proiezione salvata su disco, se presente."""
+    try:
+        with open(TSNE_CACHE_FILE, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Errore nel caricamento della proiezione t-SNE: {str(e)}")
+        return None
+
+def _save_tsne_state(state: Dict) -> None:
+    """Salva la proiezione su disco in modo atomico."""
+    try:
+        os.makedirs(os.path.dirname(TSNE_CACHE_FILE), exist_ok=True)
+        tmp_file = TSNE_CACHE_FILE + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, TSNE_CACHE_FILE)
+    except Exception as e:
+        logger.error(f"Errore nel salvataggio della proiezione t-SNE: {str(e)}")
+
+# Pagina principale con interfaccia utente
+INDEX_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -267,6 +477,16 @@ async def get_index():
                 }
             }
 
+            function renderResult(result) {
+                return `
+                    <div class="result-item">
+                        <h4>${result.metadata.file_path}</h4>
+                        <p class="similarity">Rilevanza: ${(result.similarity * 100).toFixed(1)}%</p>
+                        <p><strong>Contenuto:</strong> ${result.document}</p>
+                    </div>
+                `;
+            }
+
             async function search() {
                 try {
                     const query = document.getElementById('search-input').value;
@@ -289,22 +509,32 @@ async def get_index():
                         throw new Error('Errore nella ricerca');
                     }
 
-                    const results = await response.json();
-                    
-                    if (results.length === 0) {
-                        document.getElementById('results').innerHTML = '<p>Nessun risultato trovato</p>';
-                        return;
+                    // I risultati arrivano come NDJSON: mostra ciascuno appena ricevuto
+                    const resultsDiv = document.getElementById('results');
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
+                    let count = 0;
+                    while (true) {
+                        const { done, value } = await reader.read();
+                        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                        const lines = buffer.split('\\n');
+                        buffer = done ? '' : lines.pop();
+                        for (const line of lines) {
+                            if (!line) {
+                                continue;
+                            }
+                            resultsDiv.insertAdjacentHTML('beforeend', renderResult(JSON.parse(line)));
+                            count++;
+                        }
+                        if (done) {
+                            break;
+                        }
                     }
-
-                    const resultsHtml = results.map(result => `
-                        <div class="result-item">
-                            <h4>${result.metadata.file_path}</h4>
-                            <p class="similarity">Rilevanza: ${(result.similarity * 100).toFixed(1)}%</p>
-                            <p><strong>Contenuto:</strong> ${result.document}</p>
-                        </div>
-                    `).join('');
                     
-                    document.getElementById('results').innerHTML = resultsHtml;
+                    if (count === 0) {
+                        resultsDiv.innerHTML = '<p>Nessun risultato trovato</p>';
+                    }
                 } catch (error) {
                     document.getElementById('error').textContent = error.message;
                     console.error('Errore:', error);
@@ -351,32 +581,65 @@ async def get_index():
     </body>
     </html>
     """
+_INDEX_PAGE = _precompress(INDEX_HTML)
+
+@app.get("/", response_class=HTMLResponse)
+async def get_index(request: Request):
+    """Pagina principale con interfaccia utente."""
+    return _page_response(request, _INDEX_PAGE)
 
 @app.get("/stats")
 async def get_stats():
     """Ottieni statistiche sul database."""
     try:
-        return embeddings_manager.get_collection_stats()
+        return await run_in_threadpool(embeddings_manager.get_collection_stats)
     except Exception as e:
         logger.error(f"Errore nel recupero delle statistiche: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/search")
 async def search(request: SearchRequest):
-    """Cerca nel database vettoriale."""
+    """Cerca nel database vettoriale, restituendo i risultati come NDJSON (uno per riga)."""
     try:
         logger.info(f"Ricerca per query: {request.query}")
-        results = embeddings_manager.find_similar_documents(request.query, request.n_results)
-        return [
-            {
+        results = await run_in_threadpool(
+            embeddings_manager.find_similar_documents, request.query, request.n_results
+        )
+    except Exception as e:
+        logger.error(f"Errore durante la ricerca: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def ndjson_lines():
+        for result in results:
+            yield orjson.dumps({
                 "document": result["document"],
                 "metadata": result["metadata"],
                 "similarity": result["relevance"]
-            }
-            for result in results
+            }) + b"\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+@app.post("/search/batch")
+async def search_batch(request: BatchSearchRequest):
+    """Cerca più query nel database vettoriale con un'unica interrogazione."""
+    try:
+        logger.info(f"Ricerca batch per {len(request.queries)} query")
+        results = await run_in_threadpool(
+            embeddings_manager.find_similar_documents_batch, request.queries, request.n_results
+        )
+        return [
+            [
+                {
+                    "document": result["document"],
+                    "metadata": result["metadata"],
+                    "similarity": result["relevance"]
+                }
+                for result in query_results
+            ]
+            for query_results in results
         ]
     except Exception as e:
-        logger.error(f"Errore durante la ricerca: {str(e)}")
+        logger.error(f"Errore durante la ricerca batch: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 def start_api():
@@ -2,15 +2,33 @@ import os
 import hashlib
 import chromadb
 from chromadb.config import Settings
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import logging
 from ollama_client import OllamaClient
 import numpy as np
-from scipy.special import softmax
-import json
+import orjson
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+# Dimensione dei blocchi letti per calcolare l'hash dei file
+HASH_CHUNK_SIZE = 1 << 20
+
+@lru_cache(maxsize=4096)
+def _file_hash(file_path: str, size: int, mtime_ns: int, inode: int, ctime_ns: int) -> str:
+    """Hash BLAKE2b del file letto a blocchi da 1 MiB, in cache finché nessuno dei dati di stat nella chiave cambia."""
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def _chunk_hash(chunk: str) -> str:
+    """Hash del testo di un chunk, salvato nei metadati per riconoscere i chunk invariati."""
+    return hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).hexdigest()
+
 class EmbeddingsManager:
     def __init__(self, vault_path: str):
         """Inizializza il gestore degli embedding."""
@@ -21,7 +39,11 @@ class EmbeddingsManager:
         self.ollama = OllamaClient(
             host=os.getenv("OLLAMA_HOST", "http://localhost:11434"),
             model=os.getenv("OLLAMA_MODEL", "deepseek-r1"),
-            embedding_model=os.getenv("OLLAMA_EMBEDDING_MODEL", "mxbai-embed-large")
+            embedding_model=os.getenv("OLLAMA_EMBEDDING_MODEL", "mxbai-embed-large"),
+            keep_alive=os.getenv("OLLAMA_KEEP_ALIVE"),
+            batch_size=int(os.getenv("OLLAMA_EMBED_BATCH_SIZE", "64")),
+            cache_path=os.getenv("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite3"),
+            max_concurrency=int(os.getenv("OLLAMA_MAX_CONCURRENCY", "4"))
         )
         
         # Verifica che Ollama sia in esecuzione
@@ -42,7 +64,12 @@ class EmbeddingsManager:
         
         # Carica o crea il file di stato dell'indicizzazione
         self.index_state_file = os.path.join(self.persist_dir, "index_state.json")
+        self._index_state_mtime_ns = None
         self.index_state = self._load_index_state()
+        self._index_state_dirty = False
+        self._defer_saves = 0
+        # Protegge lo stato e le scritture sulla collezione quando si indicizza da più thread
+        self._lock = threading.RLock()
         
         logger.info("EmbeddingsManager inizializzato con successo")
 
@@ -50,62 +77,117 @@ class EmbeddingsManager:
         """Carica lo stato dell'indicizzazione da file."""
         try:
             if os.path.exists(self.index_state_file):
-                with open(self.index_state_file, 'r') as f:
-                    return json.load(f)
+                with open(self.index_state_file, 'rb') as f:
+                    self._index_state_mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                    return orjson.loads(f.read())
             return {}
         except Exception as e:
             logger.error(f"Errore nel caricamento dello stato dell'indicizzazione: {str(e)}")
             return {}
 
     def _save_index_state(self):
-        """Salva lo stato dell'indicizzazione su file."""
+        """Salva lo stato dell'indicizzazione su file in modo atomico."""
         try:
             # Assicurati che la directory esista
             os.makedirs(self.persist_dir, exist_ok=True)
             
-            with open(self.index_state_file, 'w') as f:
-                json.dump(self.index_state, f)
+            # Scrivi su un file temporaneo e sostituisci: un'interruzione non lascia mai un JSON troncato
+            with self._lock:
+                tmp_file = self.index_state_file + ".tmp"
+                with open(tmp_file, 'wb') as f:
+                    f.write(orjson.dumps(self.index_state))
+                os.replace(tmp_file, self.index_state_file)
+                self._index_state_mtime_ns = os.stat(self.index_state_file).st_mtime_ns
+                self._index_state_dirty = False
         except Exception as e:
             logger.error(f"Errore nel salvataggio dello stato dell'indicizzazione: {str(e)}")
 
-    def _get_file_hash(self, file_path: str) -> str:
-        """Calcola l'hash MD5 del contenuto del file."""
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+    def _refresh_index_state(self):
+        """Ricarica lo stato se il file è stato riscritto da un altro gestore (es. l'indicizzatore)."""
+        try:
+            mtime_ns = os.stat(self.index_state_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if mtime_ns != self._index_state_mtime_ns and not self._index_state_dirty:
+                self.index_state = self._load_index_state()
+
+    def _mark_index_state_dirty(self):
+        """Segnala una modifica allo stato: viene salvato subito, o alla fine di deferred_state_saves."""
+        with self._lock:
+            self._index_state_dirty = True
+            if not self._defer_saves:
+                self._save_index_state()
+
+    @contextmanager
+    def deferred_state_saves(self):
+        """Rimanda il salvataggio dello stato alla fine del blocco, invece di riscrivere il JSON dopo ogni file."""
+        with self._lock:
+            self._defer_saves += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._defer_saves -= 1
+                if not self._defer_saves and self._index_state_dirty:
+                    self._save_index_state()
+
+    def _get_file_hash(self, file_path: str, file_info: Dict[str, Any]) -> str:
+        """Hash del contenuto del file, riusato finché dimensione, date e inode non cambiano."""
+        # L'inode distingue un file sostituito da un altro con stessa dimensione e data di modifica,
+        # proprio il caso in cui is_file_indexed ricorre all'hash
+        return _file_hash(file_path, file_info["size"], file_info["mtime_ns"], file_info["inode"], file_info["ctime_ns"])
 
     def _get_file_info(self, file_path: str) -> Dict[str, Any]:
-        """Ottiene le informazioni di un file."""
+        """Ottiene le informazioni di un file; l'hash viene calcolato a parte, solo quando serve."""
         try:
             stat = os.stat(file_path)
-            return {
+            file_info = {
                 "size": stat.st_size,
-                "mtime": stat.st_mtime,
-                "hash": self._get_file_hash(file_path)
+                # In nanosecondi: un float perde precisione nel confronto
+                "mtime_ns": stat.st_mtime_ns,
+                "inode": stat.st_ino,
+                "ctime_ns": stat.st_ctime_ns,
+                "hash": None
             }
+            return file_info
         except Exception as e:
             logger.error(f"Errore nell'ottenimento delle informazioni del file {file_path}: {str(e)}")
             return None
 
-    def is_file_indexed(self, file_path: str) -> bool:
-        """Verifica se un file è già stato indicizzato e non è stato modificato."""
+    def is_file_indexed(self, file_path: str, current_info: Optional[Dict[str, Any]] = None) -> bool:
+        """Verifica se un file è già stato indicizzato e non è stato modificato (current_info evita un secondo stat)."""
         try:
-            # Ottieni le informazioni attuali del file
-            current_info = self._get_file_info(file_path)
+            # Controlla se il file è nello stato dell'indicizzazione
+            stored_info = self.index_state.get(file_path)
+            if not stored_info:
+                return False
+
+            # Ottieni le informazioni attuali del file (solo stat, senza leggerlo)
+            if current_info is None:
+                current_info = self._get_file_info(file_path)
             if not current_info:
                 return False
 
-            # Controlla se il file è nello stato dell'indicizzazione
-            if file_path in self.index_state:
-                stored_info = self.index_state[file_path]
-                # Verifica che hash, dimensione e data di modifica corrispondano
-                return (stored_info["hash"] == current_info["hash"] and
-                        stored_info["size"] == current_info["size"] and
-                        stored_info["mtime"] == current_info["mtime"])
-            
-            return False
+            # Dimensione diversa: il file è sicuramente cambiato
+            if stored_info["size"] != current_info["size"]:
+                return False
+
+            # Stessa dimensione, data di modifica e inode: il file non è cambiato
+            if (stored_info.get("mtime_ns") == current_info["mtime_ns"] and
+                    stored_info.get("inode") == current_info["inode"]):
+                return True
+
+            # I metadati sono cambiati ma il contenuto potrebbe essere lo stesso: confronta l'hash
+            if stored_info.get("hash") != self._get_file_hash(file_path, current_info):
+                return False
+
+            # Contenuto invariato: aggiorna i metadati così al prossimo controllo basta lo stat
+            with self._lock:
+                stored_info["mtime_ns"] = current_info["mtime_ns"]
+                stored_info["inode"] = current_info["inode"]
+                self._mark_index_state_dirty()
+            return True
         except Exception as e:
             logger.error(f"Errore nel controllo dell'indicizzazione del file {file_path}: {str(e)}")
             return False
@@ -113,66 +195,179 @@ class EmbeddingsManager:
     def add_or_update_document(self, file_path: str, chunks: List[str]) -> None:
         """Aggiunge o aggiorna un documento nella collezione."""
         try:
-            # Ottieni le informazioni del file
-            file_info = self._get_file_info(file_path)
-            if not file_info:
-                raise ValueError(f"Impossibile ottenere le informazioni del file {file_path}")
-            
-            # Verifica se il file è già indicizzato e non è stato modificato
-            if self.is_file_indexed(file_path):
-                logger.info(f"Il file {file_path} è già indicizzato e non è stato modificato")
+            plan = self.prepare_document(file_path, chunks)
+            if plan is None:
                 return
             
-            # Rimuovi le vecchie versioni del documento
-            self.collection.delete(
-                where={"file_path": file_path}
-            )
-            
-            # Genera gli embedding per i chunk
-            embeddings = self.ollama.get_embeddings_batch(chunks)
+            # Genera gli embedding dei chunk cambiati in un'unica chiamata
+            embeddings = self.ollama.get_embeddings_batch(plan["texts"])
+            self._write_document(plan, embeddings)
+        except Exception as e:
+            logger.error(f"Errore nell'indicizzazione del documento {file_path}: {str(e)}")
+            raise
+
+    def prepare_document(self, file_path: str, chunks: List[str]) -> Optional[Dict[str, Any]]:
+        """Prepara le scritture di un documento per add_prepared_documents; restituisce None se il file non è cambiato."""
+        # Ottieni le informazioni del file una sola volta
+        file_info = self._get_file_info(file_path)
+        if not file_info:
+            raise ValueError(f"Impossibile ottenere le informazioni del file {file_path}")
+        
+        # Verifica se il file è già indicizzato e non è stato modificato
+        if self.is_file_indexed(file_path, file_info):
+            logger.info(f"Il file {file_path} è già indicizzato e non è stato modificato")
+            return None
+        
+        # L'hash serve per i metadati; se is_file_indexed l'ha già calcolato viene dalla cache
+        file_info["hash"] = self._get_file_hash(file_path, file_info)
+        
+        # Prepara id e metadati di tutti i chunk
+        ids = [f"{file_path}_{i}" for i in range(len(chunks))]
+        chunk_hashes = [_chunk_hash(chunk) for chunk in chunks]
+        metadatas = [
+            {
+                "file_path": file_path,
+                "file_hash": file_info["hash"],
+                "chunk_hash": chunk_hashes[i],
+                "chunk_index": i,
+                "total_chunks": len(chunks)
+            }
+            for i in range(len(chunks))
+        ]
+        
+        # Confronta con i chunk già indicizzati: solo quelli cambiati vanno ricalcolati
+        # Senza voce nello stato (file nuovo, o stato perso prima del salvataggio) il numero di chunk è
+        # sconosciuto: la collezione può comunque contenerne, e _write_document li rimuove per metadati
+        stored_info = self.index_state.get(file_path)
+        previous_chunks = stored_info.get("chunks") if stored_info else None
+        previous_hashes = self._get_chunk_hashes(ids[:previous_chunks]) if previous_chunks else {}
+        changed = [i for i in range(len(chunks)) if previous_hashes.get(ids[i]) != chunk_hashes[i]]
+        unchanged = [i for i in range(len(chunks)) if previous_hashes.get(ids[i]) == chunk_hashes[i]]
+        
+        # "texts" contiene i chunk di cui add_prepared_documents deve calcolare l'embedding
+        return {
+            "file_path": file_path,
+            "file_info": file_info,
+            "chunks": chunks,
+            "ids": ids,
+            "metadatas": metadatas,
+            "previous_chunks": previous_chunks,
+            "changed": changed,
+            "unchanged": unchanged,
+            "texts": [chunks[i] for i in changed]
+        }
+
+    def add_prepared_documents(self, plans: List[Dict[str, Any]]) -> Dict[str, Exception]:
+        """Scrive più documenti preparati e restituisce gli errori per file (vuoto se è andato tutto bene)."""
+        # Un'unica chiamata per i chunk di tutti i file riempie i batch inviati a Ollama anche quando
+        # ogni file ne ha pochi
+        embeddings = self.ollama.get_embeddings_batch([text for plan in plans for text in plan["texts"]])
+        
+        errors = {}
+        offset = 0
+        for plan in plans:
+            count = len(plan["texts"])
+            try:
+                self._write_document(plan, embeddings[offset:offset + count])
+            except Exception as e:
+                logger.error(f"Errore nell'indicizzazione del documento {plan['file_path']}: {str(e)}")
+                errors[plan["file_path"]] = e
+            offset += count
+        return errors
+
+    def _write_document(self, plan: Dict[str, Any], embeddings: List[List[float]]) -> None:
+        """Applica alla collezione un piano di prepare_document, con gli embedding dei chunk cambiati."""
+        file_path = plan["file_path"]
+        chunks = plan["chunks"]
+        ids = plan["ids"]
+        metadatas = plan["metadatas"]
+        previous_chunks = plan["previous_chunks"]
+        changed = plan["changed"]
+        unchanged = plan["unchanged"]
+        
+        # Le scritture di un file avvengono insieme, senza intrecciarsi con quelle di altri thread
+        with self._lock:
+            if previous_chunks is None:
+                # Numero di chunk sconosciuto: rimuovi l'eventuale vecchia versione per metadati
+                self.collection.delete(
+                    where={"file_path": file_path}
+                )
+            elif previous_chunks > len(chunks):
+                # Gli id sono posizionali: vanno rimossi solo i chunk oltre la nuova lunghezza
+                self.collection.delete(
+                    ids=[f"{file_path}_{i}" for i in range(len(chunks), previous_chunks)]
+                )
             
-            # Prepara i metadati
-            metadatas = []
-            for i in range(len(chunks)):
-                metadata = {
-                    "file_path": file_path,
-                    "file_hash": file_info["hash"],
-                    "chunk_index": i,
-                    "total_chunks": len(chunks)
-                }
-                metadatas.append(metadata)
+            # Aggiungi o sostituisci i chunk cambiati con una sola scrittura
+            if changed:
+                self.collection.upsert(
+                    embeddings=embeddings,
+                    documents=[chunks[i] for i in changed],
+                    metadatas=[metadatas[i] for i in changed],
+                    ids=[ids[i] for i in changed]
+                )
             
-            # Aggiungi i chunk alla collezione
-            self.collection.add(
-                embeddings=embeddings,
-                documents=chunks,
-                metadatas=metadatas,
-                ids=[f"{file_path}_{i}" for i in range(len(chunks))]
-            )
+            # Per i chunk invariati basta aggiornare i metadati: l'indice HNSW non viene toccato
+            if unchanged:
+                self.collection.update(
+                    metadatas=[metadatas[i] for i in unchanged],
+                    ids=[ids[i] for i in unchanged]
+                )
             
             # Aggiorna lo stato dell'indicizzazione
+            file_info = plan["file_info"]
+            file_info["chunks"] = len(chunks)
             self.index_state[file_path] = file_info
-            self._save_index_state()
-            
-            logger.info(f"Documento {file_path} indicizzato con successo")
-        except Exception as e:
-            logger.error(f"Errore nell'indicizzazione del documento {file_path}: {str(e)}")
-            raise
+            self._mark_index_state_dirty()
+        
+        logger.info(f"Documento {file_path} indicizzato con successo ({len(changed)}/{len(chunks)} chunk cambiati)")
+
+    def _get_chunk_hashes(self, ids: List[str]) -> Dict[str, str]:
+        """Hash dei chunk già indicizzati con questi id (lettura per id, senza scansione dei metadati)."""
+        # Chroma tratta una lista di id vuota come assenza di filtro e leggerebbe l'intera collezione
+        if not ids:
+            return {}
+        results = self.collection.get(ids=ids, include=["metadatas"])
+        return {
+            chunk_id: metadata.get("chunk_hash")
+            for chunk_id, metadata in zip(results["ids"], results["metadatas"])
+        }
+
+    def remove_document(self, file_path: str) -> None:
+        """Rimuove un documento dalla collezione e dallo stato dell'indicizzazione."""
+        with self._lock:
+            stored_info = self.index_state.pop(file_path, None)
+            previous_chunks = stored_info.get("chunks") if stored_info else None
+            if previous_chunks is not None:
+                # Gli id sono deterministici: si eliminano direttamente, senza scorrere i metadati
+                if previous_chunks:
+                    self.collection.delete(
+                        ids=[f"{file_path}_{i}" for i in range(previous_chunks)]
+                    )
+            else:
+                # Numero di chunk sconosciuto (file non nello stato o stato precedente): rimuovi per metadati
+                self.collection.delete(
+                    where={"file_path": file_path}
+                )
+            if stored_info is not None:
+                self._mark_index_state_dirty()
 
     def _calculate_relevance(self, distances: List[float]) -> List[float]:
-        """Calcola la rilevanza normalizzata usando softmax sulle distanze."""
-        # Converti le distanze in array numpy
-        distances = np.array(distances)
+        """Calcola la rilevanza normalizzata tra 0 e 1 (softmax sulle distanze, poi min-max)."""
+        distances = np.asarray(distances, dtype=np.float64)
+        if distances.size == 0:
+            return []
         
-        # Normalizza le distanze (più piccole = più rilevanti)
-        # Usa softmax per ottenere una distribuzione di probabilità
-        # Moltiplica per -1 perché vogliamo che le distanze più piccole abbiano probabilità più alte
-        relevance = softmax(-distances)
+        # Nella normalizzazione min-max il denominatore della softmax si semplifica:
+        # bastano gli esponenziali, traslati in modo che il più vicino valga esattamente 1
+        scores = np.exp(distances.min() - distances)
+        lowest = scores.min()
         
-        # Normalizza tra 0 e 1
-        relevance = (relevance - relevance.min()) / (relevance.max() - relevance.min())
+        # Distanze tutte uguali: i documenti sono ugualmente rilevanti (prima si otteneva NaN)
+        if lowest == 1.0:
+            return [1.0] * distances.size
         
-        return relevance.tolist()
+        return ((scores - lowest) / (1.0 - lowest)).tolist()
 
     def find_similar_documents(self, query: str, n_results: int = 5) -> List[Dict[str, Any]]:
         """Trova i documenti più simili alla query."""
@@ -187,38 +382,60 @@ class EmbeddingsManager:
                 include=["documents", "metadatas", "distances"]
             )
             
-            # Calcola la rilevanza normalizzata
-            relevance_scores = self._calculate_relevance(results["distances"][0])
+            return self._format_query_results(results, 0)
+        except Exception as e:
+            logger.error(f"Errore nella ricerca di documenti simili: {str(e)}")
+            raise
+
+    def find_similar_documents_batch(self, queries: List[str], n_results: int = 5) -> List[List[Dict[str, Any]]]:
+        """Trova i documenti più simili a ciascuna query con un'unica interrogazione della collezione."""
+        if not queries:
+            return []
+        try:
+            # Genera gli embedding di tutte le query insieme (cache delle query, non quella dei chunk)
+            query_embeddings = self.ollama.get_query_embeddings(queries)
             
-            # Formatta i risultati
-            formatted_results = []
-            for i in range(len(results["documents"][0])):
-                formatted_results.append({
-                    "document": results["documents"][0][i],
-                    "metadata": results["metadatas"][0][i],
-                    "distance": results["distances"][0][i],
-                    "relevance": relevance_scores[i]
-                })
+            # Una sola query a ChromaDB: i risultati sono già raggruppati per query
+            results = self.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                include=["documents", "metadatas", "distances"]
+            )
             
-            return formatted_results
+            return [self._format_query_results(results, q) for q in range(len(queries))]
         except Exception as e:
-            logger.error(f"Errore nella ricerca di documenti simili: {str(e)}")
+            logger.error(f"Errore nella ricerca batch di documenti simili: {str(e)}")
             raise
 
+    def _format_query_results(self, results: Dict[str, Any], q: int) -> List[Dict[str, Any]]:
+        """Formatta i risultati di ChromaDB relativi alla q-esima query."""
+        # Calcola la rilevanza normalizzata
+        relevance_scores = self._calculate_relevance(results["distances"][q])
+        
+        # Formatta i risultati
+        formatted_results = []
+        for i in range(len(results["documents"][q])):
+            formatted_results.append({
+                "document": results["documents"][q][i],
+                "metadata": results["metadatas"][q][i],
+                "distance": results["distances"][q][i],
+                "relevance": relevance_scores[i]
+            })
+        
+        return formatted_results
+
     def get_collection_stats(self) -> Dict[str, int]:
         """Ottiene le statistiche della collezione."""
         try:
-            # Ottieni tutti i metadati
-            results = self.collection.get(include=["metadatas"])
-            metadatas = results["metadatas"]
-            
-            # Calcola le statistiche
-            unique_files = len(set(m["file_path"] for m in metadatas))
-            total_chunks = len(metadatas)
+            # Lo stato dell'indicizzazione ha una voce per file: niente scansione dei metadati.
+            # Le note vuote (0 chunk) non hanno documenti nella collezione e non vengono contate
+            self._refresh_index_state()
+            with self._lock:
+                unique_files = sum(1 for info in self.index_state.values() if info.get("chunks") != 0)
             
             return {
                 "unique_files": unique_files,
-                "total_chunks": total_chunks
+                "total_chunks": self.collection.count()
             }
         except Exception as e:
             logger.error(f"Errore nel recupero delle statistiche: {str(e)}")
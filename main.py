@@ -10,6 +10,8 @@ from api import start_api
 import logging
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import itertools
 
 # Configurazione logging
 logging.basicConfig(level=logging.INFO)
@@ -26,6 +28,9 @@ if not VAULT_PATH:
 DEBOUNCE_TIME = int(os.getenv("DEBOUNCE_TIME", "2"))
 INDEX_ALL_ON_START = os.getenv("INDEX_ALL_ON_START", "true").lower() == "true"
 START_WEB_VIEWER = os.getenv("START_WEB_VIEWER", "true").lower() == "true"
+# File letti e confrontati con l'indice in parallelo durante l'indicizzazione completa
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", "8"))
+INDEX_EMBED_BATCH = int(os.getenv("INDEX_EMBED_BATCH", "128"))
 
 # Carica i percorsi da escludere
 EXCLUDED_PATHS = os.getenv("EXCLUDED_PATHS", "").split(",")
@@ -39,17 +44,29 @@ text_splitter = RecursiveCharacterTextSplitter(
     length_function=len
 )
 
+# Percorsi esclusi risolti una volta sola rispetto al vault, come percorsi assoluti: il percorso
+# stesso (file o cartella) e tutto ciò che contiene. Assoluti perché VAULT_PATH può essere relativo
+# mentre il watcher riporta percorsi assoluti (su macOS FSEvents dà sempre il percorso reale)
+_EXCLUDED_EXACT = frozenset(os.path.abspath(os.path.join(VAULT_PATH, excluded)) for excluded in EXCLUDED_PATHS)
+_EXCLUDED_PREFIXES = tuple(excluded + os.sep for excluded in _EXCLUDED_EXACT)
+
 def should_exclude_path(path: str) -> bool:
     """Verifica se un percorso deve essere escluso dall'indicizzazione."""
-    # Converti il percorso in relativo rispetto al vault
-    rel_path = os.path.relpath(path, VAULT_PATH)
-    # Verifica se il percorso inizia con uno dei percorsi esclusi
-    return any(rel_path.startswith(excluded) for excluded in EXCLUDED_PATHS)
+    # abspath lavora sulla stringa (più un getcwd); startswith con una tupla confronta tutti i prefissi in C
+    path = os.path.abspath(path)
+    return path in _EXCLUDED_EXACT or path.startswith(_EXCLUDED_PREFIXES)
 
 class MarkdownHandler(FileSystemEventHandler):
     def __init__(self, embeddings_manager):
         self.embeddings_manager = embeddings_manager
+        # Ultima elaborazione di ogni file (time.monotonic), file in attesa, timer che li elaborerà,
+        # file in corso di elaborazione e quelli tra questi eliminati nel frattempo
         self.last_modified = {}
+        self.pending = set()
+        self.timer = None
+        self.processing = set()
+        self.deleted = set()
+        # Protegge solo questo stato: l'elaborazione avviene fuori dal lock
         self.lock = threading.Lock()
 
     def on_modified(self, event):
@@ -63,23 +80,8 @@ class MarkdownHandler(FileSystemEventHandler):
             logger.debug(f"File escluso dall'indicizzazione: {event.src_path}")
             return
             
-        with self.lock:
-            current_time = time.time()
-            last_time = self.last_modified.get(event.src_path, 0)
-            
-            if current_time - last_time < DEBOUNCE_TIME:
-                return
-                
-            self.last_modified[event.src_path] = current_time
-            
-            try:
-                logger.info(f"📝 File modificato: {os.path.basename(event.src_path)}")
-                content = utils.read_markdown_file(event.src_path)
-                text = utils.markdown_to_text(content)
-                chunks = text_splitter.split_text(text)
-                self.embeddings_manager.add_or_update_document(event.src_path, chunks)
-            except Exception as e:
-                logger.error(f"Errore nell'elaborazione del file {event.src_path}: {str(e)}")
+        logger.info(f"📝 File modificato: {os.path.basename(event.src_path)}")
+        self._handle_change(event.src_path)
 
     def on_created(self, event):
         if event.is_directory:
@@ -92,14 +94,77 @@ class MarkdownHandler(FileSystemEventHandler):
             logger.debug(f"File escluso dall'indicizzazione: {event.src_path}")
             return
             
+        logger.info(f"✨ Nuovo file rilevato: {os.path.basename(event.src_path)}")
+        self._handle_change(event.src_path)
+
+    def _handle_change(self, file_path):
+        """Indicizza un file creato o modificato; gli eventi ravvicinati vengono elaborati insieme da un unico timer."""
+        with self.lock:
+            current_time = time.monotonic()
+            elapsed = current_time - self.last_modified.get(file_path, float("-inf"))
+            
+            if file_path in self.processing or elapsed < DEBOUNCE_TIME:
+                self.pending.add(file_path)
+                # Per un file in corso il timer viene riarmato quando l'elaborazione termina
+                if file_path not in self.processing:
+                    self._schedule_pending(DEBOUNCE_TIME - elapsed)
+                return
+                
+            self.last_modified[file_path] = current_time
+            self.processing.add(file_path)
+            
+        self._run([file_path])
+
+    def _schedule_pending(self, delay):
+        """Avvia il timer dei file in attesa, se non è già armato. Da chiamare con il lock."""
+        if self.timer is None:
+            self.timer = threading.Timer(max(delay, 0), self._process_pending)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _process_pending(self):
+        """Elabora insieme i file modificati durante la finestra di debounce."""
+        with self.lock:
+            self.timer = None
+            # I file ancora in elaborazione restano in attesa: li riprende il timer riarmato da _run
+            file_paths = [file_path for file_path in self.pending if file_path not in self.processing]
+            self.pending.difference_update(file_paths)
+            self.processing.update(file_paths)
+            current_time = time.monotonic()
+            for file_path in file_paths:
+                self.last_modified[file_path] = current_time
+        if file_paths:
+            self._run(file_paths)
+
+    def _run(self, file_paths):
+        """Elabora dei file già segnati come in corso e riarma il timer per quelli tornati in attesa."""
         try:
-            logger.info(f"✨ Nuovo file rilevato: {os.path.basename(event.src_path)}")
-            content = utils.read_markdown_file(event.src_path)
-            text = utils.markdown_to_text(content)
-            chunks = text_splitter.split_text(text)
-            self.embeddings_manager.add_or_update_document(event.src_path, chunks)
-        except Exception as e:
-            logger.error(f"Errore nell'elaborazione del nuovo file {event.src_path}: {str(e)}")
+            self._process_files(file_paths)
+        finally:
+            with self.lock:
+                deleted = self.deleted.intersection(file_paths)
+            # Eliminati durante l'elaborazione: la scrittura appena conclusa li ha reinseriti
+            for file_path in deleted:
+                self._remove_document(file_path)
+            with self.lock:
+                self.deleted.difference_update(file_paths)
+                self.processing.difference_update(file_paths)
+                if self.pending:
+                    self._schedule_pending(DEBOUNCE_TIME)
+
+    def _process_files(self, file_paths):
+        """Indicizza di nuovo dei file, calcolando i loro embedding con un'unica chiamata."""
+        plans = []
+        for file_path in file_paths:
+            try:
+                plan = prepare_file(self.embeddings_manager, file_path)
+            except Exception as e:
+                logger.error(f"Errore nell'elaborazione del file {file_path}: {str(e)}")
+                continue
+            if plan is not None:
+                plans.append(plan)
+        if plans:
+            write_prepared_files(self.embeddings_manager, plans)
 
     def on_deleted(self, event):
         if event.is_directory:
@@ -112,30 +177,61 @@ class MarkdownHandler(FileSystemEventHandler):
             logger.debug(f"File escluso dall'indicizzazione: {event.src_path}")
             return
             
+        with self.lock:
+            self.pending.discard(event.src_path)
+            # Un'elaborazione in corso potrebbe riscrivere il file nella collezione: verrà rimosso di nuovo al termine
+            if event.src_path in self.processing:
+                self.deleted.add(event.src_path)
+            
+        logger.info(f"🗑️ File eliminato: {os.path.basename(event.src_path)}")
+        self._remove_document(event.src_path)
+
+    def _remove_document(self, file_path):
+        """Rimuove un file dalla collezione."""
         try:
-            logger.info(f"🗑️ File eliminato: {os.path.basename(event.src_path)}")
-            self.embeddings_manager.collection.delete(
-                where={"file_path": event.src_path}
-            )
+            self.embeddings_manager.remove_document(file_path)
         except Exception as e:
-            logger.error(f"Errore nell'eliminazione del file {event.src_path}: {str(e)}")
+            logger.error(f"Errore nell'eliminazione del file {file_path}: {str(e)}")
+
+def collect_markdown_files():
+    """Raccoglie con una sola visita del vault i file markdown da indicizzare e conta quelli esclusi."""
+    file_paths = []
+    excluded_files = 0
+    for entry in utils.iter_files(VAULT_PATH, onerror=log_walk_error):
+        if entry.name.endswith('.md'):
+            if should_exclude_path(entry.path):
+                excluded_files += 1
+            else:
+                file_paths.append(entry.path)
+    return file_paths, excluded_files
+
+def log_walk_error(error: OSError) -> None:
+    """Segnala una directory del vault che non è stato possibile leggere."""
+    logger.error(f"Impossibile leggere la directory {error.filename}: {str(error)}")
+
+def prepare_file(embeddings_manager: EmbeddingsManager, file_path: str):
+    """Legge, converte e suddivide un file; restituisce il piano di indicizzazione (None se invariato)."""
+    content = utils.read_markdown_file(file_path)
+    text = utils.markdown_to_text_fast(content)
+    chunks = text_splitter.split_text(text)
+    return embeddings_manager.prepare_document(file_path, chunks)
+
+def write_prepared_files(embeddings_manager: EmbeddingsManager, plans) -> None:
+    """Calcola insieme gli embedding di un gruppo di file preparati e li scrive nella collezione."""
+    try:
+        errors = embeddings_manager.add_prepared_documents(plans)
+    except Exception as e:
+        # L'embedding dell'intero gruppo è fallito
+        errors = {plan["file_path"]: e for plan in plans}
+    for file_path, e in errors.items():
+        logger.error(f"Errore nell'indicizzazione del file {file_path}: {str(e)}")
 
 def index_all_files():
     """Indicizza tutti i file markdown nella directory."""
     try:
-        total_files = 0
-        processed_files = 0
-        excluded_files = 0
-        
-        # Conta il numero totale di file
-        for root, _, files in os.walk(VAULT_PATH):
-            for file in files:
-                if file.endswith('.md'):
-                    file_path = os.path.join(root, file)
-                    if should_exclude_path(file_path):
-                        excluded_files += 1
-                    else:
-                        total_files += 1
+        # Elenca i file una volta sola: il totale è la lunghezza dell'elenco
+        file_paths, excluded_files = collect_markdown_files()
+        total_files = len(file_paths)
         
         if total_files == 0:
             logger.warning("❌ Nessun file markdown trovato nel vault.")
@@ -143,23 +239,46 @@ def index_all_files():
             
         logger.info(f"📚 Trovati {total_files} file markdown da processare (esclusi {excluded_files} file).")
         
-        # Processa i file
-        for root, _, files in os.walk(VAULT_PATH):
-            for file in files:
-                if file.endswith('.md'):
-                    file_path = os.path.join(root, file)
-                    if should_exclude_path(file_path):
-                        continue
+        # Lettura, conversione e confronto con l'indice procedono in parallelo; i chunk da calcolare
+        # di più file vengono accumulati e inviati a Ollama in batch di almeno INDEX_EMBED_BATCH.
+        # Lo stato dell'indicizzazione viene salvato una sola volta alla fine
+        processed_files = 0
+        pending_plans = []
+        pending_chunks = 0
+        with embeddings_manager.deferred_state_saves():
+            with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as pool:
+                # Solo INDEX_WORKERS * 4 file in volo alla volta: i piani già scritti non restano in memoria
+                remaining = iter(file_paths)
+                futures = {}
+                for file_path in itertools.islice(remaining, INDEX_WORKERS * 4):
+                    futures[pool.submit(prepare_file, embeddings_manager, file_path)] = file_path
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        file_path = futures.pop(future)
+                        next_path = next(remaining, None)
+                        if next_path is not None:
+                            futures[pool.submit(prepare_file, embeddings_manager, next_path)] = next_path
                         
-                    try:
                         processed_files += 1
-                        logger.info(f"⏳ Processando {processed_files}/{total_files}: {file}")
-                        content = utils.read_markdown_file(file_path)
-                        text = utils.markdown_to_text(content)
-                        chunks = text_splitter.split_text(text)
-                        embeddings_manager.add_or_update_document(file_path, chunks)
-                    except Exception as e:
-                        logger.error(f"Errore nell'indicizzazione del file {file_path}: {str(e)}")
+                        try:
+                            plan = future.result()
+                            logger.info(f"⏳ Processato {processed_files}/{total_files}: {os.path.basename(file_path)}")
+                        except Exception as e:
+                            logger.error(f"Errore nell'indicizzazione del file {file_path}: {str(e)}")
+                            continue
+                        
+                        if plan is None:
+                            continue
+                        pending_plans.append(plan)
+                        pending_chunks += len(plan["texts"])
+                        if pending_chunks >= INDEX_EMBED_BATCH:
+                            write_prepared_files(embeddings_manager, pending_plans)
+                            pending_plans = []
+                            pending_chunks = 0
+            
+            if pending_plans:
+                write_prepared_files(embeddings_manager, pending_plans)
         
         logger.info(f"✅ Indicizzazione completata! Processati {processed_files}/{total_files} file.")
     except Exception as e:
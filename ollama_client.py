@@ -1,16 +1,112 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Union
 import logging
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+def _normalize(vectors: Union[List[float], List[List[float]]]) -> Union[List[float], List[List[float]]]:
+    """Scala uno o più embedding a norma 1: la similarità coseno diventa un prodotto scalare."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).tolist()
+
+class _EmbeddingCache:
+    """Cache persistente degli embedding in float16, indicizzata per hash del testo e modello (SQLite)."""
+
+    # Parametri per singola query IN (...), sotto il limite delle versioni più vecchie di SQLite
+    _MAX_PARAMS = 500
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache "
+            "(hash TEXT NOT NULL, model TEXT NOT NULL, vec BLOB NOT NULL, PRIMARY KEY (hash, model))"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str) -> str:
+        """Hash del testo usato come chiave."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get_many(self, keys: List[str], model: str) -> Dict[str, List[float]]:
+        """Restituisce gli embedding in cache per le chiavi date (quelle assenti sono omesse)."""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), self._MAX_PARAMS):
+                batch = unique_keys[start:start + self._MAX_PARAMS]
+                rows = self._conn.execute(
+                    f"SELECT hash, vec FROM embedding_cache WHERE model = ? AND hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch]
+                ).fetchall()
+                found.update((key, np.frombuffer(vec, dtype=np.float16).astype(np.float32).tolist()) for key, vec in rows)
+        return found
+
+    @staticmethod
+    def quantize(vec: List[float]) -> np.ndarray:
+        """Arrotonda un embedding alla precisione con cui viene salvato."""
+        return np.asarray(vec, dtype=np.float16)
+
+    def set_many(self, items: Dict[str, np.ndarray], model: str) -> None:
+        """Salva gli embedding già arrotondati con quantize."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (hash, model, vec) VALUES (?, ?, ?)",
+                [(key, model, vec.tobytes()) for key, vec in items.items()]
+            )
+            self._conn.commit()
+
 class OllamaClient:
-    def __init__(self, host: str, model: str, embedding_model: str):
+    def __init__(self, host: str, model: str, embedding_model: str, keep_alive: Optional[Union[str, int]] = None,
+                 batch_size: int = 64, cache_path: Optional[str] = None, query_cache_size: int = 1024,
+                 max_concurrency: int = 4):
         self.host = host
         self.model = model
         self.embedding_model = embedding_model
         self.base_url = f"{host}/api"
+        # Testi inviati in una sola richiesta a /api/embed
+        self.batch_size = max(1, batch_size)
+        # None finché non si sa se il server supporta /api/embed (Ollama >= 0.3)
+        self._batch_endpoint = None
+        # Embedding già calcolati: i chunk invariati non vengono inviati di nuovo al server
+        self.cache = _EmbeddingCache(cache_path) if cache_path else None
+        # LRU in memoria per gli embedding delle query: le stesse ricerche tornano spesso
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.RLock()
+        # Batch dello stesso elenco inviati in parallelo: Ollama elabora più richieste insieme (OLLAMA_NUM_PARALLEL)
+        self.max_concurrency = max(1, max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency) if self.max_concurrency > 1 else None
+        # Connessioni keep-alive riusate tra le richieste, anche da più thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(8, self.max_concurrency))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Quanto a lungo Ollama tiene il modello in memoria dopo una richiesta (default del server: 5m).
+        # Accetta una durata ("30m") o un numero di secondi (-1 = sempre)
+        if isinstance(keep_alive, str) and keep_alive.lstrip("-").isdigit():
+            keep_alive = int(keep_alive)
+        self.keep_alive = keep_alive if keep_alive != "" else None
+
+    def _with_keep_alive(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Aggiunge keep_alive alla richiesta, se configurato."""
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
 
     def generate(self, prompt: str, system: str = None) -> str:
         """Genera una risposta usando il modello di chat."""
@@ -24,7 +120,7 @@ class OllamaClient:
             if system:
                 payload["system"] = system
 
-            response = requests.post(f"{self.base_url}/generate", json=payload)
+            response = self.session.post(f"{self.base_url}/generate", json=self._with_keep_alive(payload))
             response.raise_for_status()
             
             return response.json()["response"]
@@ -33,14 +129,60 @@ class OllamaClient:
             raise
 
     def get_embeddings(self, text: str) -> List[float]:
-        """Ottiene gli embedding per un testo usando il modello di embedding."""
+        """Ottiene gli embedding normalizzati per un testo, passando dalla cache LRU delle query."""
+        key = (self.embedding_model, text)
+        with self._query_cache_lock:
+            embedding = self._query_cache.get(key)
+            if embedding is not None:
+                self._query_cache.move_to_end(key)
+                return embedding
+        
+        embedding = _normalize(self._get_embeddings_uncached(text))
+        self._store_query_embeddings({key: embedding})
+        return embedding
+
+    def get_query_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Ottiene gli embedding normalizzati di più query, passando dalla cache LRU delle query."""
+        keys = [(self.embedding_model, text) for text in texts]
+        found = {}
+        with self._query_cache_lock:
+            for key in keys:
+                embedding = self._query_cache.get(key)
+                if embedding is not None:
+                    self._query_cache.move_to_end(key)
+                    found[key] = embedding
+        
+        # Query da calcolare, ciascuna una sola volta anche se ripetuta
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            # Calcolate insieme, senza la cache persistente dei chunk: le ricerche non vengono salvate
+            # su disco né arrotondate a float16, come in get_embeddings
+            fresh = dict(zip(missing, _normalize(self._get_embeddings_batch([text for _, text in missing]))))
+            self._store_query_embeddings(fresh)
+            found.update(fresh)
+        
+        return [found[key] for key in keys]
+
+    def _store_query_embeddings(self, embeddings: Dict[Any, List[float]]) -> None:
+        """Aggiunge degli embedding alla cache LRU delle query, eliminando i meno recenti."""
+        if self.query_cache_size <= 0:
+            return
+        with self._query_cache_lock:
+            for key, embedding in embeddings.items():
+                self._query_cache[key] = embedding
+                self._query_cache.move_to_end(key)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+
+    def _get_embeddings_uncached(self, text: str) -> List[float]:
+        """Chiede al server l'embedding di un testo."""
         try:
             payload = {
                 "model": self.embedding_model,
                 "prompt": text
             }
             
-            response = requests.post(f"{self.base_url}/embeddings", json=payload)
+            response = self.session.post(f"{self.base_url}/embeddings", json=self._with_keep_alive(payload))
             response.raise_for_status()
             
             return response.json()["embedding"]
@@ -49,13 +191,90 @@ class OllamaClient:
             raise
 
     def get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
-        """Ottiene gli embedding per una lista di testi."""
-        return [self.get_embeddings(text) for text in texts]
+        """Ottiene gli embedding normalizzati per una lista di testi, calcolando solo quelli non in cache."""
+        if self.cache is None:
+            return _normalize(self._get_embeddings_batch(texts))
+        
+        keys = [_EmbeddingCache.key(text) for text in texts]
+        cached = self.cache.get_many(keys, self.embedding_model)
+        
+        # Testi da calcolare, ciascuno una sola volta anche se ripetuto
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        
+        if missing:
+            fresh = self._get_embeddings_batch(list(missing.values()))
+            computed = {key: _EmbeddingCache.quantize(vec) for key, vec in zip(missing, fresh)}
+            self.cache.set_many(computed, self.embedding_model)
+            # I vettori nuovi sono arrotondati come quelli letti dalla cache: un chunk ha sempre lo
+            # stesso embedding, che venga dal server o dalla cache
+            cached.update((key, vec.astype(np.float32).tolist()) for key, vec in computed.items())
+        
+        # Normalizzati in un'unica operazione sull'intero batch, anche i vettori già in cache
+        return _normalize([cached[key] for key in keys])
+
+    def _get_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        """Chiede al server gli embedding di più testi, in batch di batch_size e con fino a max_concurrency richieste insieme."""
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        results = []
+        # La prima richiesta stabilisce se il server supporta /api/embed
+        if batches and self._batch_endpoint is None:
+            results.append(self._embed_batch(batches.pop(0)))
+        if self._executor is not None and len(batches) > 1:
+            # map restituisce i risultati nell'ordine dei batch
+            results.extend(self._executor.map(self._embed_batch, batches))
+        else:
+            results.extend(self._embed_batch(batch) for batch in batches)
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        """Embedding di un batch: una richiesta a /api/embed, o una per testo sui server più vecchi."""
+        if self._batch_endpoint is not False:
+            batch_embeddings = self._embed(batch)
+            if batch_embeddings is not None:
+                return batch_embeddings
+        # Server senza /api/embed: un testo per richiesta
+        return [self._get_embeddings_uncached(text) for text in batch]
+
+    def _embed(self, texts: List[str]) -> Optional[List[List[float]]]:
+        """Ottiene gli embedding di più testi con una sola richiesta a /api/embed (None se il server non la supporta)."""
+        try:
+            payload = {
+                "model": self.embedding_model,
+                "input": texts
+            }
+            
+            response = self.session.post(f"{self.base_url}/embed", json=self._with_keep_alive(payload))
+            # Anche un modello non ancora scaricato dà 404, ma con un errore JSON: si passa al vecchio
+            # endpoint solo se manca la route, altrimenti l'errore viene sollevato e si riprova /api/embed
+            if response.status_code == 404 and self._batch_endpoint is None and self._is_missing_route(response):
+                logger.info("Ollama non supporta /api/embed: uso /api/embeddings un testo alla volta")
+                self._batch_endpoint = False
+                return None
+            response.raise_for_status()
+            self._batch_endpoint = True
+            
+            return response.json()["embeddings"]
+        except Exception as e:
+            logger.error(f"Errore nell'ottenimento degli embedding: {str(e)}")
+            raise
+
+    @staticmethod
+    def _is_missing_route(response: requests.Response) -> bool:
+        """Indica se un 404 viene dal router di Ollama (route inesistente) e non dall'API."""
+        try:
+            body = response.json()
+        except ValueError:
+            # Il router risponde in testo semplice: "404 page not found"
+            return True
+        return not (isinstance(body, dict) and "error" in body)
 
     def health_check(self) -> bool:
         """Verifica che il server Ollama sia in esecuzione."""
         try:
-            response = requests.get(f"{self.base_url}/version")
+            response = self.session.get(f"{self.base_url}/version")
             response.raise_for_status()
             return True
         except Exception as e:
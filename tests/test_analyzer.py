@@ -0,0 +1,45 @@
+import unittest
+
+from analyzer import NoteAnalyzer
+
+
+class ParseConnectionTest(unittest.TestCase):
+    def setUp(self):
+        # _parse_connection does not touch the model, so skip loading it
+        self.analyzer = NoteAnalyzer.__new__(NoteAnalyzer)
+
+    def test_all_sections(self):
+        text = (
+            "1. Relationship: Both notes cover\nspaced repetition.\n"
+            "2. Shared Concepts:\n- Anki\n- Leitner boxes\n"
+            "3. Practical Applications: Review the cards\ndaily."
+        )
+        self.assertEqual(self.analyzer._parse_connection(text), {
+            "relationship": "Both notes cover spaced repetition.",
+            "shared_concepts": ["- Anki", "- Leitner boxes"],
+            "practical_applications": "Review the cards daily."
+        })
+
+    def test_missing_relationship_header(self):
+        text = (
+            "The notes are closely related.\n"
+            "2. Shared Concepts:\n- Anki\n"
+            "3. Practical Applications: Review the cards daily."
+        )
+        self.assertEqual(self.analyzer._parse_connection(text), {
+            "relationship": "",
+            "shared_concepts": ["- Anki"],
+            "practical_applications": "Review the cards daily."
+        })
+
+    def test_truncated_after_relationship(self):
+        text = "1. Relationship: Both notes cover spaced repetition."
+        self.assertEqual(self.analyzer._parse_connection(text), {
+            "relationship": "Both notes cover spaced repetition.",
+            "shared_concepts": [],
+            "practical_applications": ""
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+
+from utils import markdown_to_text_fast
+
+
+class MarkdownToTextFastTest(unittest.TestCase):
+    def test_frontmatter_removed(self):
+        text = "---\ntitle: Note\ntags: a\n---\nBody text"
+        self.assertEqual(markdown_to_text_fast(text), "Body text")
+
+    def test_fenced_code_kept_verbatim(self):
+        text = "Before\n```python\n  x = a_b * 2  # [[not a link]]\n```\nAfter"
+        self.assertEqual(markdown_to_text_fast(text), "Before\n  x = a_b * 2  # [[not a link]]\nAfter")
+
+    def test_wiki_links(self):
+        self.assertEqual(markdown_to_text_fast("See [[note|alias]] and [[other]]"), "See alias and other")
+
+    def test_links_and_images(self):
+        self.assertEqual(markdown_to_text_fast("Read [text](http://example.com) ![img](a.png)"), "Read text img")
+
+    def test_emphasis_removed_and_snake_case_kept(self):
+        self.assertEqual(markdown_to_text_fast("**bold** _em_ snake_case"), "bold em snake_case")
+
+    def test_negative_number_kept(self):
+        self.assertEqual(markdown_to_text_fast("-5 degrees\n- -3 offset"), "-5 degrees\n-3 offset")
+
+    def test_comparisons_kept(self):
+        self.assertEqual(markdown_to_text_fast("a < b and c > d"), "a < b and c > d")
+
+    def test_html_tags_removed(self):
+        self.assertEqual(markdown_to_text_fast("<span>tag</span> text"), "tag text")
+
+    def test_block_markers_stripped(self):
+        text = "# Heading\n> quote\n- item\n* star\n+ plus\n---"
+        self.assertEqual(markdown_to_text_fast(text), "Heading\nquote\nitem\nstar\nplus")
+
+
+if __name__ == "__main__":
+    unittest.main()
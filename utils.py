@@ -1,38 +1,114 @@
 import os
 import markdown
-from typing import List, Dict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 import re
+import threading
+
+# Compiled once instead of on every call
+_FRONTMATTER_RE = re.compile(r'^---\s*\n(.*?)\n---\s*\n', re.DOTALL)
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+# Inline markup handled by markdown_to_text_fast, in order: wiki links ([[note]] or [[note|alias]]),
+# links and images ([text](url)), code spans, HTML tags (only tag-like ones, so "a < b and c > d"
+# survives), and emphasis markers (* ~, and _ only at word edges so snake_case words survive)
+_INLINE_MARKUP_RE = re.compile(
+    r'!?\[\[([^\]|]*)(?:\|([^\]]*))?\]\]'
+    r'|!?\[([^\]]*)\]\([^)]*\)'
+    r'|`([^`]*)`'
+    r'|</?[A-Za-z][^>]*>'
+    r'|[*~]+|(?<!\w)_+|_+(?!\w)'
+)
+_CODE_FENCES = ('```', '~~~')
+# Block markers stripped from the start of a line: headings, quotes, horizontal rules, and bullets
+# (only when followed by a space, so the sign of "-5" survives)
+_BLOCK_PREFIX_RE = re.compile(r'^(?:(?:[#>]+|[-*+](?=\s|$)|[-*_](?:\s*[-*_]){2,}\s*$)\s*)*')
+
+# Reusing one converter avoids rebuilding the Markdown extension pipeline for every file.
+# A Markdown instance keeps state while converting, so it is only used under its lock.
+_MARKDOWN = markdown.Markdown()
+_MARKDOWN_LOCK = threading.Lock()
 
 def read_markdown_file(file_path: str) -> str:
     """Read and return the content of a markdown file."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
+    # One fstat and one read on a raw descriptor, bypassing the buffered io stack.
+    # O_BINARY keeps Windows from translating newlines or stopping at 0x1A.
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        # One byte more than the size, as io.readall does: a short read already means EOF
+        requested = os.fstat(fd).st_size + 1
+        data = os.read(fd, requested)
+        if len(data) == requested:
+            # The file grew after fstat: read the rest
+            parts = [data]
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                parts.append(chunk)
+            data = b''.join(parts)
+    finally:
+        os.close(fd)
+    content = data.decode('utf-8')
+    # Same newlines as a text-mode read
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
 
-def extract_metadata(content: str) -> Dict[str, str]:
-    """Extract YAML frontmatter from markdown content."""
-    metadata = {}
-    yaml_pattern = re.compile(r'^---\s*\n(.*?)\n---\s*\n', re.DOTALL)
-    match = yaml_pattern.match(content)
+def split_frontmatter(content: str) -> Tuple[Dict[str, str], str]:
+    """Split markdown content into its YAML frontmatter metadata and the body that follows."""
+    # match is anchored at the start, so only the frontmatter itself is scanned
+    match = _FRONTMATTER_RE.match(content)
+    if not match:
+        return {}, content
     
-    if match:
-        yaml_content = match.group(1)
-        for line in yaml_content.split('\n'):
-            if ':' in line:
-                key, value = line.split(':', 1)
-                metadata[key.strip()] = value.strip()
+    metadata = {}
+    for line in match.group(1).split('\n'):
+        if ':' in line:
+            key, value = line.split(':', 1)
+            metadata[key.strip()] = value.strip()
     
+    return metadata, content[match.end():]
+
+def extract_metadata(content: str) -> Dict[str, str]:
+    """Extract YAML frontmatter from markdown content."""
+    metadata, _ = split_frontmatter(content)
     return metadata
 
 def markdown_to_text(content: str) -> str:
     """Convert markdown content to plain text."""
     # Remove YAML frontmatter
-    content = re.sub(r'^---\s*\n.*?\n---\s*\n', '', content, flags=re.DOTALL)
+    _, content = split_frontmatter(content)
     
     # Convert markdown to HTML and then strip HTML tags
-    html = markdown.markdown(content)
-    text = re.sub(r'<[^>]+>', '', html)
+    with _MARKDOWN_LOCK:
+        html = _MARKDOWN.reset().convert(content)
+    text = _HTML_TAG_RE.sub('', html)
     return text.strip()
 
+def _inline_text(match: re.Match) -> str:
+    """Text kept for a piece of inline markup matched by _INLINE_MARKUP_RE."""
+    return match.group(2) or match.group(1) or match.group(3) or match.group(4) or ''
+
+def markdown_to_text_fast(content: str) -> str:
+    """Convert markdown content to plain text in one pass over its lines, without rendering HTML."""
+    # Remove YAML frontmatter
+    _, content = split_frontmatter(content)
+    
+    lines = []
+    in_code_fence = False
+    for line in content.splitlines():
+        stripped = line.strip()
+        if stripped.startswith(_CODE_FENCES):
+            in_code_fence = not in_code_fence
+            continue
+        if in_code_fence:
+            # Code is kept verbatim, as markdown_to_text does
+            lines.append(line)
+            continue
+        # Some formatting residue can remain, which is fine for embeddings
+        lines.append(_INLINE_MARKUP_RE.sub(_inline_text, _BLOCK_PREFIX_RE.sub('', stripped, count=1)))
+    return '\n'.join(lines).strip()
+
 def get_file_id(file_path: str) -> str:
     """Generate a unique identifier for a file."""
     return os.path.splitext(os.path.basename(file_path))[0]
@@ -41,11 +117,27 @@ def is_markdown_file(file_path: str) -> bool:
     """Check if a file is a markdown file."""
     return file_path.lower().endswith(('.md', '.markdown'))
 
+def iter_files(directory: str, onerror: Optional[Callable[[OSError], None]] = None) -> Iterator[os.DirEntry]:
+    """Yield the entries of all files in a directory and its subdirectories."""
+    # os.scandir entries already know whether they are directories, so no stat call is made per entry
+    directories = [directory]
+    while directories:
+        current = directories.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    # Like os.walk, symlinked directories are not followed
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        # Only regular files (or symlinks to them): unlike os.walk, special files such as
+                        # FIFOs and sockets are deliberately skipped, since reading them could block
+                        yield entry
+        except OSError as e:
+            # Like os.walk, unreadable directories are skipped and reported to onerror if given
+            if onerror is not None:
+                onerror(e)
+
 def get_all_markdown_files(directory: str) -> List[str]:
     """Get all markdown files in a directory and its subdirectories."""
-    markdown_files = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if is_markdown_file(file):
-                markdown_files.append(os.path.join(root, file))
-    return markdown_files 
\ No newline at end of file
+    return [entry.path for entry in iter_files(directory) if is_markdown_file(entry.name)] 
\ No newline at end of file